@@ -1,12 +1,20 @@
 import numpy as np
-import scipy.sparse as sp
+from scipy.special import softmax
 
 from MCTSminisat.minisat.gym.MiniSATEnv import gym_sat_Env
 
+# set to True to validate counts and Pi against the valid actions of every node (costs extra passes per node)
+_VALIDATE = False
 
-def softmax(x):
-    e_x = np.exp(x - np.max(x))
-    return e_x / e_x.sum()
+# tau values are precomputed for levels up to this one (or resign if smaller), deeper levels call tau directly
+_MAX_TAU_TABLE_LEVEL = 1000
+
+
+def _index_dtype(n):
+    """
+    Return the smallest integer dtype (int16 or int32) that can hold indexes up to n
+    """
+    return np.int16 if n <= np.iinfo(np.int16).max else np.int32
 
 
 def get_Pi(counts, tau):
@@ -14,14 +22,12 @@ def get_Pi(counts, tau):
     if p == 1.0:
         Pi = counts / np.sum(counts)
     elif p < 500:
-        counts = counts / counts.sum()
-        # do it in small steps to prevent underflow
-        while p >= 10:
-            counts = np.power(counts, 10)
-            p = p / 10
-            counts = counts / counts.sum()
-        Pi = np.power(counts, p)
-        Pi = Pi / np.sum(Pi)
+        # work in log space to prevent underflow (zero counts become -inf and end up with 0 probability)
+        with np.errstate(divide='ignore'):
+            log_Pi = np.log(counts) * p
+        log_Pi -= log_Pi.max()
+        Pi = np.exp(log_Pi)
+        Pi /= Pi.sum()
     else:
         # assume that tau is infinitely small
         Pi = np.zeros(np.shape(counts), dtype=np.float32)
@@ -33,49 +39,70 @@ class PiStruct:
     """
     Inner class used by MCT class. It forms a tree structure and cache states, Pi, and other values for self play
     """
+    # a tree can hold many thousands of nodes, so drop the per-instance __dict__
+    __slots__ = ("size", "level", "file_no", "tau", "tau_table", "parent", "state", "valid_bits",
+                 "child_actions", "child_nodes", "repeat", "total_steps", "Pi")
 
-    def __init__(self, size, level, file_no, tau, parent=None):
+    def __init__(self, size, level, file_no, tau, tau_table, parent=None):
         """
-        size:    the size of Pi, which is the same as nact
-        level:   the level is the number of steps to reach this node
-        file_no: the index of this file in the file list (this is only used in error message)
-        tau:     the function that returns a proper tau value given the current level
-        parent:  the parent node of this Pi_struct (None for the root of this tree)
+        size:      the size of Pi, which is the same as nact
+        level:     the level is the number of steps to reach this node
+        file_no:   the index of this file in the file list (this is only used in error message)
+        tau:       the function that returns a proper tau value given the current level
+        tau_table: the array of tau values for the first levels, indexed by level (shared by all nodes of the tree)
+        parent:    the parent node of this Pi_struct (None for the root of this tree)
         """
         self.size = size
         self.level = level
         self.file_no = file_no
         self.tau = tau
+        self.tau_table = tau_table
         self.parent = parent
         self.state = None  # state is None at construction time
 
         # stateful part of this node
-        self.children = {}  # pointers to all children of this node (indexed by next_act. MAYBE added by branch_next)
+        # pointers to all children of this node (MAYBE added by branch_next), kept as a sorted array of next_acts
+        # and a list of Pi_structs parallel to it
+        self.child_actions = np.zeros(0, dtype=_index_dtype(self.size))
+        self.child_nodes = []
         self.repeat = 0  # how many times this node has been played (incremented by add_counts function)
         self.total_steps = 0  # how many total_steps for this node's play (incremented by prop_up_steps func)
         self.Pi = np.zeros(self.size, dtype=np.float32)  # this is an average of all Pis played (updated by add_counts)
 
     def add_state(self, state):
         """
-        Take the state of this Pi_struct, save it as sparse matrix, and also compute the is_valid array
+        Take the state of this Pi_struct, save it as sparse coordinates (rows, cols, shape) of the 2d state,
+        and also compute the is_valid array (kept packed as a bitset, one bit per action)
         """
         if self.state is not None:
             return
-        self.is_valid = np.reshape(np.any(state, axis=0), [self.size, ])
         state_2d = np.reshape(state, [-1, state.shape[1] * state.shape[2]])
-        self.state = sp.csc_matrix(state_2d)
+        # one scan for the nonzeros serves both the sparse coordinates and is_valid (the columns with any nonzero)
+        # NOTE: states are binary, so the nonzero values themselves need not be kept
+        rows, cols = np.nonzero(state_2d)
+        index_dtype = _index_dtype(max(state_2d.shape))
+        self.state = (rows.astype(index_dtype), cols.astype(index_dtype), state_2d.shape)
+        is_valid = np.zeros(self.size, dtype=bool)
+        is_valid[cols] = True
+        self.valid_bits = np.packbits(is_valid)
 
     def add_counts(self, counts):
         """
         Take the counts (of MCTS simulation from this state), save Pi, and return the sampled move
         """
-        assert counts.sum() == (counts * self.is_valid).sum(), "count: " + str(counts) + " is invalid: " + str(
-            self.is_valid) + " in file " + str(self.file_no)
-        temp_Pi = get_Pi(counts, self.tau(self.level))
-
-        assert (self.is_valid * temp_Pi).sum() > 0.999999, "Pi: " + str(temp_Pi) + " is invalid: " + str(
-            self.is_valid) + " in file " + str(self.file_no)
-        action = np.random.choice(range(self.size), 1, p=temp_Pi)[0]
+        if self.level < len(self.tau_table):
+            tau = self.tau_table[self.level]
+        else:  # only reached when resign is larger than _MAX_TAU_TABLE_LEVEL
+            tau = self.tau(self.level)
+        temp_Pi = get_Pi(counts, tau)
+        if _VALIDATE:
+            is_valid = np.unpackbits(self.valid_bits, count=self.size).astype(bool)
+            assert not np.any(counts[~is_valid]), "count: " + str(counts) + " is invalid: " + str(
+                is_valid) + " in file " + str(self.file_no)
+            assert temp_Pi[is_valid].sum() > 0.999999, "Pi: " + str(temp_Pi) + " is invalid: " + str(
+                is_valid) + " in file " + str(self.file_no)
+
+        action = np.random.choice(self.size, p=temp_Pi)
 
         # before returning action, average temp_Pi into self.Pi. Increment self.repeat
         self.Pi = (self.Pi * self.repeat + temp_Pi) / (self.repeat + 1)
@@ -87,17 +114,21 @@ class PiStruct:
         """
         This function MAYBE initialize a child at the "next_action" branch and return that child
         """
-        if next_action not in self.children:
-            self.children[next_action] = PiStruct(self.size, self.level + 1, self.file_no, self.tau, parent=self)
-        return self.children[next_action]
+        index = np.searchsorted(self.child_actions, next_action)
+        if index == len(self.child_nodes) or self.child_actions[index] != next_action:
+            self.child_actions = np.insert(self.child_actions, index, next_action)
+            self.child_nodes.insert(index, PiStruct(self.size, self.level + 1, self.file_no, self.tau,
+                                                   self.tau_table, parent=self))
+        return self.child_nodes[index]
 
     def prop_up_steps(self, steps):
         """
         This function prop up steps for this play, starting from the last Pi_struct node
         """
-        self.total_steps += steps
-        if self.parent is not None:
-            self.parent.prop_up_steps(steps)
+        node = self
+        while node is not None:
+            node.total_steps += steps
+            node = node.parent
 
 
 class MCT:
@@ -120,7 +151,10 @@ class MCT:
             self.Pi_root = None
             self.phase = None
         else:  # normal case: set up!
-            self.Pi_current = self.Pi_root = PiStruct(max_var1 * 2, 0, file_no, tau)
+            # tau only depends on the level, and a play is resigned once its level reaches resign
+            max_level = min(resign, _MAX_TAU_TABLE_LEVEL)
+            tau_table = np.fromiter((tau(level) for level in range(max_level + 1)), dtype=np.float64)
+            self.Pi_current = self.Pi_root = PiStruct(max_var1 * 2, 0, file_no, tau, tau_table)
             self.Pi_current.add_state(self.state)
             self.resign = resign
             self.n_repeats = n_repeat  # need to run so many repeat for this SAT problem
@@ -137,6 +171,8 @@ class MCT:
         v_value:  the v value evaluated by neural net  (when phase is False, this parameter is not used)
         Return a state (3d numpy array) if paused for evaluation.
         Return None if this problem is simulated n_repeat times (all required repeat times are finished)
+        NOTE: each call pauses at exactly one leaf, so callers should step many MCT objects in lockstep and
+        evaluate their returned states in one batched forward pass (as train.self_play and train.model_ev do)
         """
         if self.phase is None:
             return None
@@ -150,7 +186,9 @@ class MCT:
                     return self.state
                 else:
                     self.phase = False
-            self.state, need_env, need_sim = self.env.simulate(softmax(pi_array), v_value)
+                    # pi_array is only consumed (and does not change) from here on, so take its softmax once
+                    sm_pi = softmax(pi_array)
+            self.state, need_env, need_sim = self.env.simulate(sm_pi, v_value)
 
         # after simulation, save counts and make a step
         next_act = self.Pi_current.add_counts(self.env.get_visit_count())
@@ -176,17 +214,6 @@ class MCT:
         if self.Pi_root is None:
             return  # there is nothing to write
         sl_Buffer.add_from_Pi_structs(self.Pi_root)
-        return
-
-        # sub-routine to save in buffer
-        def analyze_Pi_graph_dump(Pi_node, sl_Buffer):
-            for act in Pi_node.children:
-                analyze_Pi_graph_dump(Pi_node.children[act], sl_Buffer)
-            av = Pi_node.total_steps / Pi_node.repeat
-            sl_Buffer.add(Pi_node.file_no, Pi_node.state, Pi_node.Pi, av, Pi_node.repeat)
-
-        # call subroutine
-        analyze_Pi_graph_dump(self.Pi_root, sl_Buffer)
 
     def report_performance(self):
         if self.Pi_root is None:
@@ -54,22 +54,22 @@ class slBuffer_oneFile:
         self.mean_step *= ((self.total_plays - Pi_node.repeat) / self.total_plays)
         self.mean_step += (Pi_node.total_steps / self.total_plays)
 
-        # then let's save in those data
-        def save_Pi_nodes(a_Pi_node):
+        # then let's save in those data (walk the tree with an explicit stack, deep plays would hit the recursion limit)
+        stack = [Pi_node]
+        while stack:
+            a_Pi_node = stack.pop()
             av = a_Pi_node.total_steps / a_Pi_node.repeat
             self.add_uncheck(a_Pi_node.state, a_Pi_node.Pi, av, a_Pi_node.repeat)
-            for act in a_Pi_node.children:
-                save_Pi_nodes(a_Pi_node.children[act])
-
-        save_Pi_nodes(Pi_node)
+            # push children in reverse so that they are saved in order of their actions
+            stack.extend(reversed(a_Pi_node.child_nodes))
 
     def add_uncheck(self, obs, Pi, step, repeat):
         """
         This function add samples without checking the self.mean_step value
         """
         self._prob = None
-        # obs is already 2d sparse array
-        data = (obs, Pi, step)
+        # obs is already 2d sparse coordinates, Pi is only a training target so float16 is precise enough
+        data = (obs, Pi.astype(np.float16), step)
         if self._next_idx >= len(self._storage):  # adding new data new space!
             self._storage.append(data)
             self._n_repeat.append(repeat)
@@ -79,21 +79,30 @@ class slBuffer_oneFile:
         self._next_idx = (self._next_idx + 1) % self._maxsize
 
     def _get_score(self, step):
-        return np.tanh((self.mean_step - step) * 3.0 / self.mean_step)
+        # same as tanh((mean_step - step) * 3.0 / mean_step), with the division taken out of the per-step part
+        k = 3.0 / self.mean_step
+        return np.tanh(3.0 - k * step)
 
     def _encode_sample(self, idxes):
-        obses, Pis, scores = [], [], []
+        obses, Pis, steps = [], [], []
         for i in idxes:
             data = self._storage[i]
             obs, Pi, step = data
-            # effort to convert observation (2D sparse) back to 3D numpy"
-            obs_2d = obs.toarray()
+            # effort to convert observation (2D sparse coordinates) back to 3D numpy"
+            if hasattr(obs, "toarray"):  # legacy entry saved as a scipy sparse matrix by an older buffer
+                obs_2d = obs.toarray()
+            else:
+                rows, cols, shape = obs
+                obs_2d = np.zeros(shape, dtype=np.float32)
+                obs_2d[rows, cols] = 1.0
             obs_3d = np.reshape(obs_2d, [-1, int(obs_2d.shape[1] / 2), 2])
 
             obses.append(obs_3d)
             Pis.append(Pi)
-            # effort to transform step into score
-            scores.append(self._get_score(step))
+            steps.append(step)
+
+        # effort to transform steps into scores (in one call for the whole batch)
+        scores = self._get_score(np.asarray(steps, dtype=np.float64))
 
         return (np.array(obses, dtype=np.float32),
                 np.array(Pis, dtype=np.float32),
@@ -118,7 +127,8 @@ class slBuffer_oneFile:
             rewards received as results of executing act_batch
         """
         if self._prob is None:
-            self._prob = np.array(self._n_repeat) / sum(self._n_repeat)
+            n_repeat = np.asarray(self._n_repeat, dtype=np.float64)
+            self._prob = n_repeat / n_repeat.sum()
         idxes = np.random.choice(len(self._storage), batch_size, p=self._prob)
         return self._encode_sample(idxes)
 
@@ -248,6 +248,8 @@ def self_play(args, built_model, status_track):
     They need to BE the same.
     n_batch is the degree of parallel for neural net
     n_stack is the number of history for a state
+    NOTE: the n_batch MCT objects (one file each) are independent trees, but every step needs the neural net
+    of this session, so they are run in lockstep here rather than in separate processes
     """
     # take out the parts that self_play need from the model
     X, _, _, p, v, params, _ = built_model